@@ -1,40 +1,177 @@
 """ComfyUI API 客户端"""
 
 import asyncio
-import json
+import io
+import logging
 import random
+import sys
 import uuid
-from typing import Any
+from collections import OrderedDict
+from collections.abc import Iterator
+from itertools import chain, islice
+from typing import Any, BinaryIO
 
 import aiohttp
 from astrbot.api import logger
 
+if sys.version_info >= (3, 11):
+    from asyncio import timeout as async_timeout
+else:
+    from async_timeout import timeout as async_timeout
+
+try:
+    from . import json_compat
+    from .http_session import get_session
+except ImportError:
+    import json_compat
+    from http_session import get_session
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+SEED_KEYS = ("seed", "noise_seed")  # ComfyUI 采样/噪声节点使用的种子输入名
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8", "image/jpeg"),
+    (b"GIF8", "image/gif"),
+)
+
+
+def guess_image_type(head: bytes) -> str:
+    """根据文件头推断图像 MIME 类型"""
+    for signature, mime in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mime
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
 
 class ComfyUIClient:
     """ComfyUI API 客户端"""
 
+    MAX_IMAGE_CANDIDATES = 4  # 下载失败时最多依次尝试的输出图像数量
+    HISTORY_CACHE_SIZE = 64
+    WS_RETRY_MIN = 5.0  # WebSocket 断开后的重连退避（秒），逐次翻倍
+    WS_RETRY_MAX = 120.0
+
     def __init__(self, base_url: str, timeout: int = 120):
         self.base_url = base_url.rstrip("/")
         self.timeout = timeout
+        self._t_health = aiohttp.ClientTimeout(total=min(timeout, 10))  # 健康检查最多10秒
+        self._t_history = aiohttp.ClientTimeout(total=min(timeout, 30))  # 历史查询最多30秒
+        self._t_short = aiohttp.ClientTimeout(total=5)
+        self._t_full = aiohttp.ClientTimeout(total=timeout)
         self.session: aiohttp.ClientSession | None = None
         self.client_id = str(uuid.uuid4())
+        self._ws_lock = asyncio.Lock()
+        self._ws_task: asyncio.Task | None = None
+        self._ws_connected = False
+        self._ws_retry_at = 0.0  # 早于该时间不再尝试重连
+        self._ws_backoff = self.WS_RETRY_MIN
+        self._ws_down = False  # 本次断连已记录日志
+        self._events: dict[str, asyncio.Event] = {}
+        self._results: dict[str, dict] = {}
+        self._health_cache: tuple[float, tuple[bool, str]] | None = None  # (过期时间, 结果)
+        self._health_ttl = 5.0
+        self._health_fail_ttl = 1.0
+        self.poll_interval_max = 2.0
+        self.ws_recheck_interval = 3.0  # 等待完成事件时定期复查历史，防止漏收事件
+        self._history_cache: OrderedDict[str, dict[str, Any]] = OrderedDict()
 
     async def ensure_session(self):
         """确保会话连接"""
         if self.session is None or self.session.closed:
-            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None))
+            self.session = await get_session()
+        if self._ws_task is not None and not self._ws_task.done():
+            return
+        async with self._ws_lock:
+            # 断连期间按退避间隔重试，其间直接走轮询
+            if (self._ws_task is None or self._ws_task.done()) and (
+                asyncio.get_running_loop().time() >= self._ws_retry_at
+            ):
+                self._ws_task = asyncio.create_task(self._ws_loop())
 
     async def close(self):
-        """关闭会话"""
-        if self.session and not self.session.closed:
-            await self.session.close()
+        """关闭 WebSocket 监听（共享会话由 http_session.close_session 关闭）"""
+        if self._ws_task and not self._ws_task.done():
+            self._ws_task.cancel()
+            try:
+                await self._ws_task
+            except asyncio.CancelledError:
+                pass
+        self.session = None
+
+    async def _ws_loop(self):
+        """监听 WebSocket 执行事件，连接失败时由轮询兜底"""
+        try:
+            async with self.session.ws_connect(
+                f"{self.base_url}/ws?clientId={self.client_id}", heartbeat=30
+            ) as ws:
+                self._ws_connected = True
+                self._ws_backoff = self.WS_RETRY_MIN
+                if self._ws_down:
+                    self._ws_down = False
+                    logger.info("WebSocket 已重新连接")
+                async for msg in ws:
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        continue  # 二进制帧为预览图，忽略
+                    try:
+                        frame = json_compat.loads(msg.data)
+                    except ValueError:
+                        continue
+                    if not isinstance(frame, dict):
+                        continue
+                    self._handle_ws_frame(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if not self._ws_down:
+                self._ws_down = True
+                logger.warning("WebSocket 连接失败，回退到轮询: %s", e)
+            self._ws_retry_at = asyncio.get_running_loop().time() + self._ws_backoff
+            self._ws_backoff = min(self._ws_backoff * 2, self.WS_RETRY_MAX)
+        finally:
+            self._ws_connected = False
+            # 唤醒所有等待者，使其改为轮询历史记录
+            for event in self._events.values():
+                event.set()
+
+    def _handle_ws_frame(self, frame: dict[str, Any]):
+        """处理 WebSocket 消息"""
+        msg_type = frame.get("type")
+        data = frame.get("data")
+        if not isinstance(data, dict):
+            return
+        prompt_id = data.get("prompt_id")
+        if not isinstance(prompt_id, str):
+            return
+        event = self._events.get(prompt_id)
+        if event is None:
+            return
+
+        if msg_type == "executing" and data.get("node") is None:
+            event.set()
+        elif msg_type in ("execution_error", "execution_interrupted"):
+            self._results[prompt_id] = data
+            event.set()
 
     async def check_health(self) -> tuple[bool, str]:
-        """检查服务状态"""
+        """检查服务状态（结果短时缓存，失败结果缓存更短以便尽快恢复）"""
+        now = asyncio.get_running_loop().time()
+        if self._health_cache and now < self._health_cache[0]:
+            return self._health_cache[1]
+
+        result = await self._fetch_health()
+        ttl = self._health_ttl if result[0] else self._health_fail_ttl
+        self._health_cache = (now + ttl, result)
+        return result
+
+    async def _fetch_health(self) -> tuple[bool, str]:
+        """请求 /system_stats"""
         try:
             await self.ensure_session()
-            timeout = aiohttp.ClientTimeout(total=min(self.timeout, 10))  # 健康检查最多10秒
-            async with self.session.get(f"{self.base_url}/system_stats", timeout=timeout) as resp:
+            async with self.session.get(
+                f"{self.base_url}/system_stats", timeout=self._t_health
+            ) as resp:
                 if resp.status == 200:
                     return True, "服务正常"
                 return False, f"HTTP {resp.status}"
@@ -51,34 +188,47 @@ class ComfyUIClient:
             await self.ensure_session()
             fixed_workflow, current_seed = self._enforce_deterministic_workflow(workflow)
             payload = {"prompt": fixed_workflow, "client_id": self.client_id}
+            body = json_compat.dumps(payload)
 
-            timeout = aiohttp.ClientTimeout(total=self.timeout)
             async with self.session.post(
-                f"{self.base_url}/prompt", json=payload, timeout=timeout
+                f"{self.base_url}/prompt", data=body, headers=JSON_HEADERS, timeout=self._t_full
             ) as resp:
                 if resp.status == 200:
-                    data = await resp.json()
-                    return data.get("prompt_id"), current_seed
-                error_text = await resp.text()
-                logger.error(f"提交工作流失败: {resp.status} - {error_text}")
+                    data = await resp.json(loads=json_compat.loads)
+                    prompt_id = data.get("prompt_id")
+                    if prompt_id:
+                        self._events[prompt_id] = asyncio.Event()
+                    return prompt_id, current_seed
+                if logger.isEnabledFor(logging.ERROR):
+                    error_text = await resp.text()
+                    logger.error("提交工作流失败: %s - %s", resp.status, error_text)
                 return None, None
         except Exception as e:
-            logger.error(f"提交工作流异常: {e}")
+            logger.error("提交工作流异常: %s", e)
             return None, None
 
     async def get_history(self, prompt_id: str) -> dict[str, Any] | None:
-        """获取执行历史"""
+        """获取执行历史（已完成的任务结果缓存在本地）"""
+        cached = self._history_cache.get(prompt_id)
+        if cached is not None:
+            self._history_cache.move_to_end(prompt_id)
+            return cached
+
         try:
             await self.ensure_session()
-            timeout = aiohttp.ClientTimeout(total=min(self.timeout, 30))  # 历史查询最多30秒
             async with self.session.get(
-                f"{self.base_url}/history/{prompt_id}", timeout=timeout
+                f"{self.base_url}/history/{prompt_id}", timeout=self._t_history
             ) as resp:
-                if resp.status == 200:
-                    return await resp.json()
-                return None
+                if resp.status != 200:
+                    return None
+                history = await resp.json(loads=json_compat.loads)
+            if "outputs" in history.get(prompt_id, {}):
+                self._history_cache[prompt_id] = history
+                while len(self._history_cache) > self.HISTORY_CACHE_SIZE:
+                    self._history_cache.popitem(last=False)
+            return history
         except Exception as e:
-            logger.error(f"获取历史记录异常: {e}")
+            logger.error("获取历史记录异常: %s", e)
             return None
 
     async def get_image(
@@ -88,71 +238,108 @@ class ComfyUIClient:
         try:
             await self.ensure_session()
             params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-            timeout = aiohttp.ClientTimeout(total=self.timeout)
             async with self.session.get(
-                f"{self.base_url}/view", params=params, timeout=timeout
+                f"{self.base_url}/view", params=params, timeout=self._t_full
             ) as resp:
                 if resp.status == 200:
                     return await resp.read()
-                logger.error(f"获取图像失败: {resp.status}")
+                logger.error("获取图像失败: %s", resp.status)
                 return None
         except Exception as e:
-            logger.error(f"获取图像异常: {e}")
+            logger.error("获取图像异常: %s", e)
             return None
 
     async def upload_image(
-        self, image_data: bytes, filename: str = "input.png", overwrite: bool = True
+        self, image_data: bytes | BinaryIO, filename: str = "input.png", overwrite: bool = True
     ) -> str | None:
-        """上传图像到ComfyUI"""
+        """上传图像到ComfyUI
+
+        image_data 可为 bytes 或二进制文件对象，均以流式方式写入请求体。
+        """
         try:
             await self.ensure_session()
+            if isinstance(image_data, (bytes, bytearray, memoryview)):
+                head = bytes(image_data[:12])
+                stream = io.BytesIO(image_data)
+            else:
+                stream = image_data
+                head = b""
+                if stream.seekable():
+                    pos = stream.tell()
+                    head = stream.read(12)
+                    stream.seek(pos)
+
             data = aiohttp.FormData()
-            data.add_field("image", image_data, filename=filename, content_type="image/png")
+            data.add_field(
+                "image", stream, filename=filename, content_type=guess_image_type(head)
+            )
             data.add_field("overwrite", str(overwrite).lower())
 
-            timeout = aiohttp.ClientTimeout(total=self.timeout)
             async with self.session.post(
-                f"{self.base_url}/upload/image", data=data, timeout=timeout
+                f"{self.base_url}/upload/image", data=data, timeout=self._t_full
             ) as resp:
                 if resp.status == 200:
-                    result = await resp.json()
+                    result = await resp.json(loads=json_compat.loads)
                     return result.get("name")
-                logger.error(f"上传图像失败: {resp.status}")
+                logger.error("上传图像失败: %s", resp.status)
                 return None
         except Exception as e:
-            logger.error(f"上传图像异常: {e}")
+            logger.error("上传图像异常: %s", e)
             return None
 
     async def wait_for_completion(
         self,
         prompt_id: str,
         timeout_seconds: int = 120,
-        poll_interval: float = 1.0,
+        poll_interval: float = 0.1,
         cancel_on_timeout: bool = True,
     ) -> tuple[bool, dict[str, Any] | None, str]:
-        """等待工作流完成"""
-        start_time = asyncio.get_event_loop().time()
-
-        while True:
-            elapsed = asyncio.get_event_loop().time() - start_time
-            if elapsed > timeout_seconds:
-                if cancel_on_timeout:
-                    await self.cancel_prompt(prompt_id)
-                return False, None, f"执行超时({timeout_seconds}s)"
-
-            history = await self.get_history(prompt_id)
-            if history and prompt_id in history:
-                prompt_history = history[prompt_id]
-
-                if "outputs" in prompt_history:
-                    if "status" in prompt_history:
-                        status = prompt_history["status"]
-                        if status.get("status_str") == "error":
-                            logger.error(f"ComfyUI执行错误: {status.get('messages', [])}")
-                            return False, None, "执行出错"
-                    return True, prompt_history, "执行完成"
-
-            await asyncio.sleep(poll_interval)
+        """等待工作流完成
+
+        先查询一次历史记录（完成事件可能早于提交响应到达而被丢弃）。之后 WebSocket
+        可用时等待完成事件，最长 ws_recheck_interval 秒后复查历史；否则从 poll_interval
+        开始轮询，每次未完成后间隔乘以 1.5（上限 poll_interval_max）并加 ±10% 抖动。
+        """
+        event = self._events.get(prompt_id)
+        interval = poll_interval
+
+        try:
+            async with async_timeout(timeout_seconds):
+                while True:
+                    error = self._results.get(prompt_id)
+                    if error is not None:
+                        logger.error("ComfyUI执行错误: %s", error.get("exception_message", error))
+                        return False, None, "执行出错"
+
+                    history = await self.get_history(prompt_id)
+                    if history and prompt_id in history:
+                        prompt_history = history[prompt_id]
+
+                        if "outputs" in prompt_history:
+                            if "status" in prompt_history:
+                                status = prompt_history["status"]
+                                if status.get("status_str") == "error":
+                                    logger.error("ComfyUI执行错误: %s", status.get("messages", []))
+                                    return False, None, "执行出错"
+                            return True, prompt_history, "执行完成"
+
+                    if event is not None and self._ws_connected and not event.is_set():
+                        try:
+                            async with async_timeout(self.ws_recheck_interval):
+                                await event.wait()
+                        except asyncio.TimeoutError:
+                            pass
+                        continue
+
+                    await asyncio.sleep(interval * (0.9 + random.random() * 0.2))
+                    interval = min(interval * 1.5, self.poll_interval_max)
+        except asyncio.TimeoutError:
+            if cancel_on_timeout:
+                await self.cancel_prompt(prompt_id)
+            return False, None, f"执行超时({timeout_seconds}s)"
+        finally:
+            self._events.pop(prompt_id, None)
+            self._results.pop(prompt_id, None)
 
     async def execute_workflow(
         self,
@@ -166,7 +353,7 @@ class ComfyUIClient:
             return False, None, "提交工作流失败", None
 
         used_seed = known_seed if known_seed is not None else detected_seed
-        logger.info(f"ComfyUI任务提交 ID: {prompt_id}, Seed: {used_seed}")
+        logger.info("ComfyUI任务提交 ID: %s, Seed: %s", prompt_id, used_seed)
 
         success, result, status_msg = await self.wait_for_completion(
             prompt_id, timeout_seconds=timeout_seconds
@@ -175,107 +362,121 @@ class ComfyUIClient:
         if not success:
             return False, None, status_msg, used_seed
 
-        target_image = None
-        if result and "outputs" in result:
-            for node_output in result["outputs"].values():
-                if "images" not in node_output:
-                    continue
-                for image_info in node_output["images"]:
-                    img_data = {
-                        "filename": image_info.get("filename"),
-                        "subfolder": image_info.get("subfolder", ""),
-                        "folder_type": image_info.get("type", "output"),
-                    }
-                    if img_data["folder_type"] == "output":
-                        target_image = img_data
-                        break
-                    if target_image is None:
-                        target_image = img_data
-                if target_image and target_image["folder_type"] == "output":
-                    break
-
-        if target_image:
-            image_data = await self.get_image(
-                target_image["filename"],
-                target_image["subfolder"],
-                target_image["folder_type"],
-            )
-            if image_data:
-                return True, image_data, "生成成功", used_seed
+        outputs = result.get("outputs") if result else None
+        if outputs:
+            # output 类型优先，其次是 temp 等预览图；逐个下载，首个成功即返回
+            images = self._iter_output_images
+            preferred = (c for c in images(outputs) if c["folder_type"] == "output")
+            fallback = (c for c in images(outputs) if c["folder_type"] != "output")
+            for c in islice(chain(preferred, fallback), self.MAX_IMAGE_CANDIDATES):
+                image_data = await self.get_image(c["filename"], c["subfolder"], c["folder_type"])
+                if image_data:
+                    return True, image_data, "生成成功", used_seed
 
         return False, None, "未找到输出图像", used_seed
 
-    def _enforce_deterministic_workflow(
-        self, workflow: dict[str, Any]
-    ) -> tuple[dict[str, Any], int]:
-        """强制固定随机种子"""
-        workflow_copy = json.loads(json.dumps(workflow))
+    @staticmethod
+    def _iter_output_images(outputs: dict[str, Any]) -> Iterator[dict[str, str]]:
+        """遍历历史记录中的输出图像"""
+        for node_output in outputs.values():
+            for info in node_output.get("images", ()):
+                yield {
+                    "filename": info.get("filename"),
+                    "subfolder": info.get("subfolder", ""),
+                    "folder_type": info.get("type", "output"),
+                }
+
+    def _enforce_deterministic_workflow(self, workflow: dict[str, Any]) -> tuple[dict[str, Any], int]:
+        """强制固定随机种子
+
+        只复制需要改写的节点，其余节点与传入的工作流共享引用，传入的工作流不会被修改。
+        """
+        workflow_copy = dict(workflow)
         main_seed = None
         ksampler_seed = None
 
-        for node_data in workflow_copy.values():
+        for node_id, node_data in workflow.items():
             if not isinstance(node_data, dict) or "inputs" not in node_data:
                 continue
 
             inputs = node_data["inputs"]
             class_type = node_data.get("class_type", "")
-            seed_keys = [k for k in inputs if "seed" in k.lower()]
+            new_inputs = None
 
-            for key in seed_keys:
+            for key in SEED_KEYS:
+                if key not in inputs:
+                    continue
                 current_seed = inputs[key]
                 if not isinstance(current_seed, (int, float)) or current_seed == -1:
-                    inputs[key] = random.randint(1, 2**63 - 1)
+                    if new_inputs is None:
+                        new_inputs = dict(inputs)
+                    current_seed = new_inputs[key] = random.getrandbits(63) or 1
 
                 if "Sampler" in class_type:
-                    ksampler_seed = int(inputs[key])
+                    ksampler_seed = int(current_seed)
                 elif main_seed is None:
-                    main_seed = int(inputs[key])
+                    main_seed = int(current_seed)
+
+            if inputs.get("control_after_generate") in ("randomize", "increment", "decrement"):
+                if new_inputs is None:
+                    new_inputs = dict(inputs)
+                new_inputs["control_after_generate"] = "fixed"
 
-            if "control_after_generate" in inputs:
-                if inputs["control_after_generate"] in ["randomize", "increment", "decrement"]:
-                    inputs["control_after_generate"] = "fixed"
+            if new_inputs is not None:
+                workflow_copy[node_id] = {**node_data, "inputs": new_inputs}
 
         final_seed = ksampler_seed or main_seed or 0
         return workflow_copy, final_seed
 
-    async def interrupt(self) -> bool:
-        """中断当前执行"""
+    async def interrupt(self, prompt_id: str | None = None) -> bool:
+        """中断当前执行
+
+        指定 prompt_id 时，新版 ComfyUI 仅在该任务正在运行时才中断。
+        """
         try:
             await self.ensure_session()
-            timeout = aiohttp.ClientTimeout(total=5)
-            async with self.session.post(f"{self.base_url}/interrupt", timeout=timeout) as resp:
+            body = json_compat.dumps({"prompt_id": prompt_id}) if prompt_id else None
+            async with self.session.post(
+                f"{self.base_url}/interrupt",
+                data=body,
+                headers=JSON_HEADERS if body else None,
+                timeout=self._t_short,
+            ) as resp:
                 return resp.status == 200
         except Exception as e:
-            logger.error(f"中断执行异常: {e}")
+            logger.error("中断执行异常: %s", e)
             return False
 
+    async def _delete_from_queue(self, prompt_id: str) -> bool:
+        """从等待队列删除任务"""
+        body = json_compat.dumps({"delete": [prompt_id]})
+        async with self.session.post(
+            f"{self.base_url}/api/queue", data=body, headers=JSON_HEADERS, timeout=self._t_short
+        ) as resp:
+            if resp.status != 200:
+                logger.warning("删除队列任务返回: %s", resp.status)
+            return resp.status == 200
+
     async def cancel_prompt(self, prompt_id: str) -> bool:
-        """取消指定任务"""
+        """取消指定任务（删除队列与中断并发发出）"""
+        self._history_cache.pop(prompt_id, None)
         try:
             await self.ensure_session()
-            timeout = aiohttp.ClientTimeout(total=5)
-            payload = {"delete": [prompt_id]}
-            async with self.session.post(
-                f"{self.base_url}/api/queue", json=payload, timeout=timeout
-            ) as resp:
-                if resp.status != 200:
-                    logger.warning(f"删除队列任务返回: {resp.status}")
-            await self.interrupt()
+            await asyncio.gather(self._delete_from_queue(prompt_id), self.interrupt(prompt_id))
             return True
         except Exception as e:
-            logger.error(f"取消任务异常: {e}")
+            logger.error("取消任务异常: %s", e)
             return False
 
     async def get_queue_status(self) -> tuple[int, int]:
         """获取队列状态"""
         try:
             await self.ensure_session()
-            timeout = aiohttp.ClientTimeout(total=5)
-            async with self.session.get(f"{self.base_url}/queue", timeout=timeout) as resp:
+            async with self.session.get(f"{self.base_url}/queue", timeout=self._t_short) as resp:
                 if resp.status == 200:
-                    data = await resp.json()
+                    data = await resp.json(loads=json_compat.loads)
                     return len(data.get("queue_running", [])), len(data.get("queue_pending", []))
                 return 0, 0
         except Exception as e:
-            logger.error(f"获取队列状态异常: {e}")
+            logger.error("获取队列状态异常: %s", e)
             return 0, 0
@@ -0,0 +1,33 @@
+"""共享 HTTP 会话"""
+
+import aiohttp
+
+_SESSION: aiohttp.ClientSession | None = None
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """获取进程级共享会话（复用连接池与 keep-alive）"""
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=128,
+                limit_per_host=32,  # 流量集中在 ComfyUI 与 q1.qlogo.cn 两个主机
+                use_dns_cache=True,
+                ttl_dns_cache=600,
+                enable_cleanup_closed=True,
+                keepalive_timeout=75,
+                force_close=False,
+            ),
+            # 仅限制建连时间，总超时由各请求自行指定
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=None),
+        )
+    return _SESSION
+
+
+async def close_session():
+    """关闭共享会话"""
+    global _SESSION
+    if _SESSION is not None and not _SESSION.closed:
+        await _SESSION.close()
+    _SESSION = None
@@ -1,62 +1,85 @@
 """AstrBot 图片获取工具"""
 
+import asyncio
 import os
 import tempfile
+import time
 import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import ClassVar
 
-import aiofiles
 import aiohttp
 from astrbot.api import logger
 from astrbot.api.all import At, Image, Reply
 from astrbot.api.event import AstrMessageEvent
 
+try:
+    from .http_session import get_session
+except ImportError:
+    from http_session import get_session
+
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=60)
+
 
 class ImageFetcher:
     """图片获取工具类"""
 
+    AVATAR_CACHE_TTL = 300  # 头像缓存有效期（秒）
+    AVATAR_CACHE_SIZE = 128
+    _avatar_cache: ClassVar[OrderedDict[str, tuple[float, bytes]]] = OrderedDict()  # 进程内共享
+
     @staticmethod
     async def download_url(url: str) -> bytes | None:
         """下载 URL 图片"""
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as resp:
-                    if resp.status == 200:
-                        return await resp.read()
-                    logger.warning(f"下载失败: {resp.status}, URL: {url}")
-                    return None
+            session = await get_session()
+            async with session.get(url, timeout=DOWNLOAD_TIMEOUT) as resp:
+                if resp.status == 200:
+                    return await resp.read()
+                logger.warning("下载失败: %s, URL: %s", resp.status, url)
+                return None
         except Exception as e:
-            logger.warning(f"下载异常: {e}")
+            logger.warning("下载异常: %s", e)
             return None
 
-    @staticmethod
-    async def get_avatar_bytes(user_id: str) -> bytes | None:
-        """获取 QQ 头像"""
-        if not user_id.isdigit():
-            return None
+    @classmethod
+    async def get_avatar_bytes(cls, user_id: str) -> bytes | None:
+        """获取 QQ 头像（带 TTL 的 LRU 缓存），user_id 需为纯数字 QQ 号"""
+        now = time.monotonic()
+        cached = cls._avatar_cache.get(user_id)
+        if cached and now - cached[0] < cls.AVATAR_CACHE_TTL:
+            cls._avatar_cache.move_to_end(user_id)
+            return cached[1]
+
         avatar_url = f"https://q1.qlogo.cn/g?b=qq&nk={user_id}&s=640"
-        return await ImageFetcher.download_url(avatar_url)
+        data = await cls.download_url(avatar_url)
+        if data:
+            cls._avatar_cache[user_id] = (now, data)
+            cls._avatar_cache.move_to_end(user_id)
+            while len(cls._avatar_cache) > cls.AVATAR_CACHE_SIZE:
+                cls._avatar_cache.popitem(last=False)
+        return data
 
     @classmethod
     async def get_image_urls(cls, event: AstrMessageEvent) -> list[str]:
-        """从事件提取图片 URL"""
-        urls: list[str] = []
-
+        """从事件提取图片 URL（并发解析，保持消息顺序）"""
         if not hasattr(event, "message_obj") or not event.message_obj:
-            return urls
-
-        if hasattr(event.message_obj, "message"):
-            for comp in event.message_obj.message:
-                if isinstance(comp, Image):
-                    url = await cls._component_to_http_url(comp)
-                    if url:
-                        urls.append(url)
-                elif isinstance(comp, Reply) and getattr(comp, "chain", None):
-                    for r in comp.chain:
-                        if isinstance(r, Image):
-                            url = await cls._component_to_http_url(r)
-                            if url:
-                                urls.append(url)
-        return urls
+            return []
+        if not hasattr(event.message_obj, "message"):
+            return []
+
+        comps = []
+        for comp in event.message_obj.message:
+            if isinstance(comp, Image):
+                comps.append(comp)
+            elif isinstance(comp, Reply) and getattr(comp, "chain", None):
+                comps.extend(r for r in comp.chain if isinstance(r, Image))
+
+        results = await asyncio.gather(
+            *(cls._component_to_http_url(c) for c in comps), return_exceptions=True
+        )
+        return [url for url in results if isinstance(url, str) and url]
 
     @staticmethod
     async def _component_to_http_url(comp) -> str | None:
@@ -96,18 +119,22 @@ class ImageFetcher:
         if urls:
             image_data = await cls.download_url(urls[0])
             if image_data:
-                logger.info(f"成功获取图片: {urls[0][:60]}...")
+                logger.info("成功获取图片: %s...", urls[0][:60])
                 return image_data
 
         if hasattr(event, "message_obj") and event.message_obj and hasattr(event.message_obj, "message"):
+            # 按出现顺序去重，剔除非数字 ID 后并发获取头像
+            qq_ids: dict[str, None] = {}
             for comp in event.message_obj.message:
                 if isinstance(comp, At):
-                    qq_id = getattr(comp, "qq", None) or getattr(comp, "uin", None)
-                    if qq_id:
-                        avatar_data = await cls.get_avatar_bytes(str(qq_id))
-                        if avatar_data:
-                            logger.info(f"成功获取头像: {qq_id}")
-                            return avatar_data
+                    qq_id = str(getattr(comp, "qq", None) or getattr(comp, "uin", None) or "")
+                    if qq_id.isascii() and qq_id.isdigit():
+                        qq_ids[qq_id] = None
+            results = await asyncio.gather(*(cls.get_avatar_bytes(qid) for qid in qq_ids))
+            for qq_id, avatar_data in zip(qq_ids, results):
+                if avatar_data:
+                    logger.info("成功获取头像: %s", qq_id)
+                    return avatar_data
         return None
 
     @classmethod
@@ -121,9 +148,8 @@ class ImageFetcher:
         file_path = os.path.join(tempfile.gettempdir(), filename)
 
         try:
-            async with aiofiles.open(file_path, "wb") as f:
-                await f.write(image_data)
+            await asyncio.to_thread(Path(file_path).write_bytes, image_data)
             return file_path
         except Exception as e:
-            logger.warning(f"保存临时文件失败: {e}")
+            logger.warning("保存临时文件失败: %s", e)
             return None
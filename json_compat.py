@@ -0,0 +1,25 @@
+"""JSON 编解码（优先使用 orjson，缺失时回退到标准库）"""
+
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+
+    def dumps(obj: Any) -> bytes:
+        """序列化为 UTF-8 字节"""
+        return orjson.dumps(obj)
+
+    loads = orjson.loads
+else:
+
+    def dumps(obj: Any) -> bytes:
+        """序列化为 UTF-8 字节"""
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    loads = json.loads
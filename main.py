@@ -1,12 +1,14 @@
 """AstrBot ComfyUI 图像生成插件"""
 
 import asyncio
-import base64
 import os
 import re
 import shutil
+import sys
 import time
 import uuid as uuid_mod
+from collections import OrderedDict
+from pathlib import Path
 
 from astrbot.api import logger
 from astrbot.api.event import AstrMessageEvent, filter
@@ -16,17 +18,43 @@ from astrbot.core.message.components import Image
 
 try:
     from .comfyui_client import ComfyUIClient
+    from .http_session import close_session
     from .image_fetcher import ImageFetcher
-    from .workflow_parser import WorkflowParser
+    from .workflow_parser import WorkflowInfo, WorkflowParser
 except ImportError:
     from comfyui_client import ComfyUIClient
+    from http_session import close_session
     from image_fetcher import ImageFetcher
-    from workflow_parser import WorkflowParser
+    from workflow_parser import WorkflowInfo, WorkflowParser
 
 PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
 BUNDLED_WORKFLOWS_DIR = os.path.join(PLUGIN_DIR, "workflows")  # 插件内置工作流目录
 WORKFLOWS_DIR = None  # 用户工作流目录，将在插件初始化时设置
 TEMP_PATH = None  # 将在插件初始化时设置
+TEMP_FILE_MAX_AGE = 30 * 60  # 生成结果临时文件保留时间（秒）
+TEMP_CLEAN_INTERVAL = 10 * 60  # 临时目录清理间隔（秒）
+MAX_USER_SETTINGS = 1024  # 保留设置的最大用户数
+CONFIG_SAVE_DELAY = 0.5  # 管理员切换配置后延迟写盘时间（秒）
+
+_GEN_RE = re.compile(r"/sdl\s+gen\s+(.+)", re.IGNORECASE | re.DOTALL)
+_I2I_RE = re.compile(r"/sdl\s+i2i\s+(.+)", re.IGNORECASE | re.DOTALL)
+_THINK_RE = re.compile(r"<think>[\s\S]*?</think>")
+
+
+def _copy_file(src_path: str, dst_path: str, src_st: os.stat_result):
+    """复制文件并保留修改时间，Linux 下使用 sendfile 在内核内完成复制"""
+    if sys.platform != "linux" or not hasattr(os, "sendfile"):
+        shutil.copy2(src_path, dst_path)
+        return
+
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        offset, size = 0, src_st.st_size
+        while offset < size:
+            sent = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+    os.utime(dst_path, ns=(src_st.st_atime_ns, src_st.st_mtime_ns))
 
 
 @register(
@@ -39,7 +67,11 @@ class SDGeneratorComfyUI(Star):
     def __init__(self, context: Context, config: AstrBotConfig):
         super().__init__(context)
         self.config = config
+        self._global_prompt = ""
+        self._add_in_head = True
+        self._save_handle: asyncio.TimerHandle | None = None
         self._validate_config()
+        self._refresh_prompt_cache()
 
         global TEMP_PATH, WORKFLOWS_DIR
         data_dir = StarTools.get_data_dir(self.context, "astrbot_plugin_easy_comfyui")
@@ -47,55 +79,150 @@ class SDGeneratorComfyUI(Star):
         WORKFLOWS_DIR = str(data_dir / "workflows")
         os.makedirs(TEMP_PATH, exist_ok=True)
         os.makedirs(WORKFLOWS_DIR, exist_ok=True)
-        
-        # 同步内置工作流到用户目录（名称相同则更新，不存在则添加，不删除用户目录中的文件）
-        self._sync_bundled_workflows()
 
         self.comfyui = ComfyUIClient(
             base_url=self.config.get("comfyui_url", "http://localhost:8188"),
             timeout=self.config.get("session_timeout_time", 120),
         )
         self.workflow_parser = WorkflowParser(WORKFLOWS_DIR)
-        self.user_settings: dict = {}
+        self._workflows_cache: list[tuple[int, str, str]] | None = None
+        self.user_settings: OrderedDict[str, dict] = OrderedDict()  # 按最近使用排序的 LRU
         self.active_tasks = 0
         self.max_concurrent_tasks = config.get("max_concurrent_tasks", 3)
         self.task_semaphore = asyncio.Semaphore(self.max_concurrent_tasks)
+        self._janitor_task: asyncio.Task | None = None
+        try:
+            self._janitor_task = asyncio.get_running_loop().create_task(self._temp_janitor())
+        except RuntimeError:
+            pass  # 无运行中的事件循环时，于首次保存结果时启动
+
+        # 同步内置工作流到用户目录（名称相同则更新，不存在则添加，不删除用户目录中的文件）
+        # 有事件循环时放到线程中执行，避免阻塞插件加载；同步完成后按需重载
+        self._sync_task: asyncio.Task | None = None
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            if self._sync_bundled_workflows():
+                self.workflow_parser.reload_workflows()
+        else:
+            self._sync_task = loop.create_task(self._sync_and_reload_workflows())
+
+    async def _sync_and_reload_workflows(self):
+        """在线程中同步内置工作流，有更新时重载解析器"""
+        try:
+            copied = await asyncio.to_thread(self._sync_bundled_workflows)
+        except Exception as e:
+            logger.warning(f"同步内置工作流失败: {e}")
+            return
+        if copied:
+            self.workflow_parser.reload_workflows()
+            self._workflows_cache = None
 
-    def _sync_bundled_workflows(self):
+    def _sync_bundled_workflows(self) -> int:
         """同步内置工作流到用户目录
         
-        名称相同则更新，不存在则添加，不删除用户目录中已有的文件
+        名称相同则更新，不存在则添加，不删除用户目录中已有的文件；返回复制的文件数
         """
         if not os.path.exists(BUNDLED_WORKFLOWS_DIR):
-            return
+            return 0
         
-        for filename in os.listdir(BUNDLED_WORKFLOWS_DIR):
-            if not filename.endswith(".json"):
-                continue
-            src_path = os.path.join(BUNDLED_WORKFLOWS_DIR, filename)
-            dst_path = os.path.join(WORKFLOWS_DIR, filename)
+        copied = 0
+        with os.scandir(BUNDLED_WORKFLOWS_DIR) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".json") or not entry.is_file():
+                    continue
+                dst_path = os.path.join(WORKFLOWS_DIR, entry.name)
+                src_st = entry.stat()
+                try:
+                    dst_st = os.stat(dst_path)
+                    if dst_st.st_mtime_ns >= src_st.st_mtime_ns and dst_st.st_size == src_st.st_size:
+                        continue  # 未变化，跳过复制
+                except FileNotFoundError:
+                    pass
+                try:
+                    _copy_file(entry.path, dst_path, src_st)
+                    copied += 1
+                    logger.debug(f"同步工作流: {entry.name}")
+                except Exception as e:
+                    logger.warning(f"同步工作流 {entry.name} 失败: {e}")
+        return copied
+
+    async def _save_result_image(self, image_data: bytes) -> str:
+        """将生成结果写入临时目录，返回文件路径"""
+        if self._janitor_task is None or self._janitor_task.done():
+            self._janitor_task = asyncio.create_task(self._temp_janitor())
+        out_path = os.path.join(TEMP_PATH, f"{uuid_mod.uuid4().hex}.png")
+        await asyncio.to_thread(Path(out_path).write_bytes, image_data)
+        return out_path
+
+    async def _temp_janitor(self):
+        """定期清理过期的临时文件"""
+        while True:
+            await asyncio.sleep(TEMP_CLEAN_INTERVAL)
             try:
-                shutil.copy2(src_path, dst_path)
-                logger.debug(f"同步工作流: {filename}")
+                await asyncio.to_thread(self._purge_temp_files)
             except Exception as e:
-                logger.warning(f"同步工作流 {filename} 失败: {e}")
+                logger.warning(f"清理临时文件失败: {e}")
+
+    @staticmethod
+    def _purge_temp_files():
+        """删除超过保留时间的临时文件"""
+        expire_before = time.time() - TEMP_FILE_MAX_AGE
+        with os.scandir(TEMP_PATH) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.stat().st_mtime < expire_before:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
 
     def _validate_config(self):
         """验证配置"""
-        comfyui_url = self.config.get("comfyui_url", "http://localhost:8188").strip()
+        raw_url = self.config.get("comfyui_url", "http://localhost:8188")
+        comfyui_url = raw_url.strip().rstrip("/")
         if not comfyui_url.startswith(("http://", "https://")):
             raise ValueError("ComfyUI地址必须以http://或https://开头")
-        if comfyui_url.endswith("/"):
-            self.config["comfyui_url"] = comfyui_url.rstrip("/")
-            self.config.save_config()
+        # 仅在规范化后确有变化时写盘
+        if comfyui_url != raw_url:
+            self.config["comfyui_url"] = comfyui_url
+            self._save_config()
+
+    def _save_config(self):
+        """保存配置并刷新缓存的配置项"""
+        self.config.save_config()
+        self._refresh_prompt_cache()
+
+    def _schedule_save(self):
+        """延迟保存配置，短时间内的多次修改合并为一次写盘"""
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+        self._save_handle = asyncio.get_running_loop().call_later(
+            CONFIG_SAVE_DELAY, self._flush_save
+        )
+
+    def _flush_save(self):
+        """立即写入待保存的配置"""
+        self._save_handle = None
+        self._save_config()
+
+    def _refresh_prompt_cache(self):
+        """缓存全局提示词配置"""
+        self._global_prompt = self.config.get("positive_prompt_global", "")
+        self._add_in_head = self.config.get("enable_positive_prompt_add_in_head_or_tail", True)
 
     def _get_user_settings(self, user_id: str) -> dict:
         """获取用户设置"""
-        if user_id not in self.user_settings:
-            self.user_settings[user_id] = {
-                "workflow": self.config.get("default_workflow_index", 1),
-            }
-        return self.user_settings[user_id]
+        settings = self.user_settings.get(user_id)
+        if settings is not None:
+            self.user_settings.move_to_end(user_id)
+            return settings
+
+        settings = self.user_settings[user_id] = {
+            "workflow": self.config.get("default_workflow_index", 1),
+        }
+        if len(self.user_settings) > MAX_USER_SETTINGS:
+            self.user_settings.popitem(last=False)
+        return settings
 
     async def _generate_prompt(self, prompt: str) -> str:
         """使用 LLM 生成提示词"""
@@ -112,31 +239,39 @@ class SDGeneratorComfyUI(Star):
         )
         response = await provider.text_chat(f"{system_prompt} {prompt}", session_id=None)
         if response.completion_text:
-            return re.sub(r"<think>[\s\S]*</think>", "", response.completion_text).strip()
+            return _THINK_RE.sub("", response.completion_text).strip()
         return ""
 
     def _build_final_prompt(self, user_prompt: str) -> str:
         """构建最终提示词"""
-        global_prompt = self.config.get("positive_prompt_global", "")
-        add_in_head = self.config.get("enable_positive_prompt_add_in_head_or_tail", True)
-        return global_prompt + user_prompt if add_in_head else user_prompt + global_prompt
-
-    def _get_generation_params(self, user_id: str) -> str:
+        if not self._global_prompt:
+            return user_prompt
+        if self._add_in_head:
+            return f"{self._global_prompt}{user_prompt}"
+        return f"{user_prompt}{self._global_prompt}"
+
+    def _workflows(self) -> list[tuple[int, str, str]]:
+        """获取工作流列表（缓存至下次重载）"""
+        if self._workflows_cache is None:
+            self._workflows_cache = self.workflow_parser.list_workflows()
+        return self._workflows_cache
+
+    def _get_generation_params(self, workflow_idx: int, workflow_info: WorkflowInfo | None) -> str:
         """获取当前生成参数"""
-        settings = self._get_user_settings(user_id)
-        workflow_idx = settings["workflow"]
-
-        workflow_info = self.workflow_parser.get_workflow(workflow_idx)
+        cfg = self.config
         workflow_name = workflow_info.name if workflow_info else "未设置"
         workflow_desc = workflow_info.description if workflow_info else ""
+        verbose = cfg.get("verbose", True)
+        enable_llm = cfg.get("enable_generate_prompt", False)
+        show_prompt = cfg.get("enable_show_positive_prompt", False)
 
         return (
             f"🎨 当前设置:\n"
             f"- 工作流: [{workflow_idx}] {workflow_name}\n"
             f"  └ {workflow_desc}\n"
-            f"- 详细输出: {'开启' if self.config.get('verbose', True) else '关闭'}\n"
-            f"- LLM生成提示词: {'开启' if self.config.get('enable_generate_prompt', False) else '关闭'}\n"
-            f"- 显示提示词: {'开启' if self.config.get('enable_show_positive_prompt', False) else '关闭'}"
+            f"- 详细输出: {'开启' if verbose else '关闭'}\n"
+            f"- LLM生成提示词: {'开启' if enable_llm else '关闭'}\n"
+            f"- 显示提示词: {'开启' if show_prompt else '关闭'}"
         )
 
     # ==================== 命令组 ====================
@@ -167,175 +302,125 @@ class SDGeneratorComfyUI(Star):
     @sdl.command("gen")
     async def generate_image(self, event: AstrMessageEvent, prompt: str = ""):
         """文生图"""
-        user_id = event.get_sender_id()
+        prompt = (prompt or "").strip()
+        if not prompt:
+            raw_message = getattr(event, "message_str", "") or ""
+            match = _GEN_RE.search(raw_message)
+            prompt = match.group(1).strip() if match else ""
 
-        if not prompt or not prompt.strip():
-            try:
-                raw_message = getattr(event, "message_str", "")
-                if raw_message:
-                    match = re.search(r"/sdl\s+gen\s+(.+)", raw_message, re.IGNORECASE | re.DOTALL)
-                    if match:
-                        prompt = match.group(1).strip()
-            except Exception as e:
-                logger.warning(f"提取prompt失败: {e}")
-
-        if not prompt or not prompt.strip():
+        if not prompt:
             yield event.plain_result("❌ 请提供提示词\n用法: /sdl gen <提示词>")
             return
 
-        async with self.task_semaphore:
-            self.active_tasks += 1
-            try:
-                available, _ = await self.comfyui.check_health()
-                if not available:
-                    yield event.plain_result("❌ 绘图服务不可用")
-                    return
-
-                start_time = time.time()
-                verbose = self.config.get("verbose", True)
-                if verbose:
-                    yield event.plain_result("🖌️ 开始画画...")
-
-                settings = self._get_user_settings(user_id)
-                workflow_idx = settings["workflow"]
-
-                if not self.workflow_parser.get_workflow(workflow_idx):
-                    yield event.plain_result(f"❌ 工作流 [{workflow_idx}] 不存在")
-                    return
-
-                if self.config.get("enable_generate_prompt", False):
-                    generated = await self._generate_prompt(prompt)
-                    positive_prompt = self._build_final_prompt(generated or prompt)
-                else:
-                    positive_prompt = self._build_final_prompt(prompt)
-
-                if self.config.get("enable_show_positive_prompt", False):
-                    yield event.plain_result(f"📝 提示词:\n{positive_prompt}")
-
-                negative_prompt = self.config.get("negative_prompt_global", "")
-
-                workflow_result = self.workflow_parser.prepare_workflow(
-                    workflow_index=workflow_idx,
-                    positive_prompt=positive_prompt,
-                    negative_prompt=negative_prompt,
-                )
-
-                if not workflow_result or not workflow_result[0]:
-                    yield event.plain_result("❌ 准备工作流失败")
-                    return
-
-                workflow, prepared_seed, _ = workflow_result
-                timeout = self.config.get("session_timeout_time", 120)
-                success, image_data, status_msg, seed = await self.comfyui.execute_workflow(
-                    workflow=workflow,
-                    timeout_seconds=timeout,
-                    known_seed=prepared_seed,
-                )
-
-                if not success:
-                    yield event.plain_result(f"❌ 生成失败: {status_msg}")
-                    return
-
-                image_base64 = base64.b64encode(image_data).decode("utf-8")
-                yield event.chain_result([Image.fromBase64(image_base64)])
-
-                if verbose:
-                    elapsed = time.time() - start_time
-                    yield event.plain_result(
-                        f"✅ 生成成功 | ⏱️ {elapsed:.2f}s | Seed: {seed or 'N/A'}"
-                    )
-
-            except asyncio.TimeoutError:
-                yield event.plain_result("⚠️ 请求超时")
-            except Exception as e:
-                logger.error(f"生成图像错误: {e}")
-                yield event.plain_result("❌ 生成失败，请查看日志")
-            finally:
-                self.active_tasks -= 1
+        async for result in self._run_generation(event, prompt, img2img=False):
+            yield result
 
     @sdl.command("i2i")
     async def img2img(self, event: AstrMessageEvent, prompt: str = ""):
         """图生图"""
-        user_id = event.get_sender_id()
+        prompt = (prompt or "").strip()
+        if not prompt:
+            raw_message = getattr(event, "message_str", "") or ""
+            match = _I2I_RE.search(raw_message)
+            prompt = match.group(1).strip() if match else ""
 
-        if not prompt or not prompt.strip():
-            try:
-                raw_message = getattr(event, "message_str", "")
-                if raw_message:
-                    match = re.search(r"/sdl\s+i2i\s+(.+)", raw_message, re.IGNORECASE | re.DOTALL)
-                    if match:
-                        prompt = match.group(1).strip()
-            except Exception as e:
-                logger.warning(f"提取prompt失败: {e}")
-
-        if not prompt or not prompt.strip():
+        if not prompt:
             yield event.plain_result(
                 "❌ 请提供提示词\n用法: /sdl i2i <提示词>\n\n"
                 "📷 图片来源:\n1. 回复图片\n2. 发送图片+命令\n3. @某人(头像)"
             )
             return
 
+        async for result in self._run_generation(event, prompt, img2img=True):
+            yield result
+
+    async def _run_generation(self, event: AstrMessageEvent, prompt: str, img2img: bool):
+        """文生图/图生图共用流程，img2img=True 时先获取并上传参考图片"""
+        if img2img:
+            task_name, start_msg, done_msg = "图生图", "📤 上传图片...\n🖌️ 开始图生图...", "✅ 完成"
+        else:
+            task_name, start_msg, done_msg = "生成", "🖌️ 开始画画...", "✅ 生成成功"
+        user_id = event.get_sender_id()
+        health_task: asyncio.Task | None = None
+        upload_task: asyncio.Task | None = None
+        prompt_task: asyncio.Task | None = None
+
         async with self.task_semaphore:
             self.active_tasks += 1
             try:
-                available, _ = await self.comfyui.check_health()
-                if not available:
-                    yield event.plain_result("❌ 绘图服务不可用")
-                    return
-
-                verbose = self.config.get("verbose", True)
-                if verbose:
-                    yield event.plain_result("🔍 获取参考图片...")
+                cfg = self.config
+                verbose = cfg.get("verbose", True)
+                enable_llm = cfg.get("enable_generate_prompt", False)
+                show_prompt = cfg.get("enable_show_positive_prompt", False)
+                neg_prompt = cfg.get("negative_prompt_global", "")
+                timeout = cfg.get("session_timeout_time", 120)
+
+                # 先做同步的工作流检查，避免无效请求触发 LLM 调用
+                settings = self._get_user_settings(user_id)
+                workflow_idx = settings["workflow"]
+                wf_info = self.workflow_parser.get_workflow(workflow_idx)
 
-                image_data = await ImageFetcher.extract_image_data(event)
-                if not image_data:
-                    yield event.plain_result(
-                        "❌ 未找到参考图片\n\n"
-                        "📷 请通过以下方式提供:\n1. 回复图片\n2. 发送图片+命令\n3. @某人(头像)\n\n"
-                        "⚠️ 引用图片需重新发送"
-                    )
+                if not wf_info:
+                    yield event.plain_result(f"❌ 工作流 [{workflow_idx}] 不存在")
                     return
 
-                if verbose:
-                    yield event.plain_result("📤 上传图片...")
+                if img2img and not wf_info.node_mapping.load_image_node:
+                    yield event.plain_result(f"❌ 工作流 [{workflow_idx}] 不支持图生图")
+                    return
 
-                upload_filename = f"i2i_{uuid_mod.uuid4().hex}.png"
-                uploaded_name = await self.comfyui.upload_image(image_data, filename=upload_filename)
+                # 健康检查与 LLM 提示词生成并行进行
+                health_task = asyncio.create_task(self.comfyui.check_health())
+                if enable_llm:
+                    prompt_task = asyncio.create_task(self._generate_prompt(prompt))
 
-                if not uploaded_name:
-                    yield event.plain_result("❌ 图片上传失败")
+                available, _ = await health_task
+                if not available:
+                    yield event.plain_result("❌ 绘图服务不可用")
                     return
 
+                if img2img:
+                    if verbose:
+                        yield event.plain_result("🔍 获取参考图片...")
+
+                    image_data = await ImageFetcher.extract_image_data(event)
+                    if not image_data:
+                        yield event.plain_result(
+                            "❌ 未找到参考图片\n\n"
+                            "📷 请通过以下方式提供:\n1. 回复图片\n2. 发送图片+命令\n3. @某人(头像)\n\n"
+                            "⚠️ 引用图片需重新发送"
+                        )
+                        return
+
+                    # 上传与 LLM 提示词生成并行进行，进度提示与开始提示合并为一条消息
+                    upload_filename = f"i2i_{uuid_mod.uuid4().hex}.png"
+                    upload_task = asyncio.create_task(
+                        self.comfyui.upload_image(image_data, filename=upload_filename)
+                    )
+
                 start_time = time.time()
                 if verbose:
-                    yield event.plain_result("🖌️ 开始图生图...")
-
-                settings = self._get_user_settings(user_id)
-                workflow_idx = settings["workflow"]
-                workflow_info = self.workflow_parser.get_workflow(workflow_idx)
-
-                if not workflow_info:
-                    yield event.plain_result(f"❌ 工作流 [{workflow_idx}] 不存在")
-                    return
-
-                if not workflow_info.node_mapping.load_image_node:
-                    yield event.plain_result(f"❌ 工作流 [{workflow_idx}] 不支持图生图")
-                    return
+                    yield event.plain_result(start_msg)
 
-                if self.config.get("enable_generate_prompt", False):
-                    generated = await self._generate_prompt(prompt)
+                if prompt_task is not None:
+                    generated = await prompt_task
                     positive_prompt = self._build_final_prompt(generated or prompt)
                 else:
                     positive_prompt = self._build_final_prompt(prompt)
 
-                if self.config.get("enable_show_positive_prompt", False):
+                if show_prompt:
                     yield event.plain_result(f"📝 提示词:\n{positive_prompt}")
 
-                negative_prompt = self.config.get("negative_prompt_global", "")
+                uploaded_name = None
+                if upload_task is not None:
+                    uploaded_name = await upload_task
+                    if not uploaded_name:
+                        yield event.plain_result("❌ 图片上传失败")
+                        return
+
                 workflow_result = self.workflow_parser.prepare_workflow(
                     workflow_index=workflow_idx,
                     positive_prompt=positive_prompt,
-                    negative_prompt=negative_prompt,
+                    negative_prompt=neg_prompt,
                     input_image_filename=uploaded_name,
                 )
 
@@ -344,7 +429,6 @@ class SDGeneratorComfyUI(Star):
                     return
 
                 workflow, prepared_seed, _ = workflow_result
-                timeout = self.config.get("session_timeout_time", 120)
                 success, image_data, status_msg, seed = await self.comfyui.execute_workflow(
                     workflow=workflow,
                     timeout_seconds=timeout,
@@ -352,24 +436,31 @@ class SDGeneratorComfyUI(Star):
                 )
 
                 if not success:
-                    yield event.plain_result(f"❌ 图生图失败: {status_msg}")
+                    yield event.plain_result(f"❌ {task_name}失败: {status_msg}")
                     return
 
-                image_base64 = base64.b64encode(image_data).decode("utf-8")
-                yield event.chain_result([Image.fromBase64(image_base64)])
+                out_path = await self._save_result_image(image_data)
+                yield event.chain_result([Image.fromFileSystem(out_path)])
 
                 if verbose:
                     elapsed = time.time() - start_time
                     yield event.plain_result(
-                        f"✅ 完成 | ⏱️ {elapsed:.2f}s | Seed: {seed or 'N/A'}"
+                        f"{done_msg} | ⏱️ {elapsed:.2f}s | Seed: {seed or 'N/A'}"
                     )
 
             except asyncio.TimeoutError:
                 yield event.plain_result("⚠️ 请求超时")
             except Exception as e:
-                logger.error(f"图生图错误: {e}")
-                yield event.plain_result("❌ 图生图失败，请查看日志")
+                logger.error(f"{task_name}错误: {e}")
+                yield event.plain_result(f"❌ {task_name}失败，请查看日志")
             finally:
+                for task in (health_task, upload_task, prompt_task):
+                    if task is None:
+                        continue
+                    if not task.done():
+                        task.cancel()
+                    elif not task.cancelled():
+                        task.exception()  # 取走提前返回时未读取的异常，避免未检索告警
                 self.active_tasks -= 1
 
     @sdl.command("wf")
@@ -378,17 +469,13 @@ class SDGeneratorComfyUI(Star):
         user_id = event.get_sender_id()
         settings = self._get_user_settings(user_id)
         current_wf = settings["workflow"]
-        workflows = self.workflow_parser.list_workflows()
-
-        wf_lines = []
-        for idx, name, desc in workflows:
-            marker = "▶️" if idx == current_wf else "  "
-            wf_lines.append(f"{marker} [{idx}] {name}")
-            if desc:
-                wf_lines.append(f"      └ {desc}")
-        wf_list_str = "\n".join(wf_lines) if wf_lines else "  (暂无工作流)"
 
         if not action:
+            wf_list_str = "\n".join(
+                f"{'▶️' if idx == current_wf else '  '} [{idx}] {name}"
+                + (f"\n      └ {desc}" if desc else "")
+                for idx, name, desc in self._workflows()
+            ) or "  (暂无工作流)"
             yield event.plain_result(
                 f"📂 工作流\n━━━━━━━━━━━━━━━━━━━━━━\n{wf_list_str}\n"
                 f"━━━━━━━━━━━━━━━━━━━━━━\n"
@@ -398,6 +485,7 @@ class SDGeneratorComfyUI(Star):
 
         if action == "reload":
             self.workflow_parser.reload_workflows()
+            self._workflows_cache = None
             count = self.workflow_parser.get_workflow_count()
             yield event.plain_result(f"🔄 已重载 {count} 个工作流")
             return
@@ -428,7 +516,7 @@ class SDGeneratorComfyUI(Star):
         """切换详细输出"""
         current = self.config.get("verbose", True)
         self.config["verbose"] = not current
-        self.config.save_config()
+        self._schedule_save()
         yield event.plain_result(f"📢 详细输出: {'开启' if not current else '关闭'}")
 
     @filter.permission_type(filter.PermissionType.ADMIN)
@@ -437,7 +525,7 @@ class SDGeneratorComfyUI(Star):
         """切换LLM提示词生成"""
         current = self.config.get("enable_generate_prompt", False)
         self.config["enable_generate_prompt"] = not current
-        self.config.save_config()
+        self._schedule_save()
         yield event.plain_result(f"🤖 LLM提示词: {'开启' if not current else '关闭'}")
 
     @filter.permission_type(filter.PermissionType.ADMIN)
@@ -446,7 +534,7 @@ class SDGeneratorComfyUI(Star):
         """切换显示提示词"""
         current = self.config.get("enable_show_positive_prompt", False)
         self.config["enable_show_positive_prompt"] = not current
-        self.config.save_config()
+        self._schedule_save()
         yield event.plain_result(f"📝 显示提示词: {'开启' if not current else '关闭'}")
 
     @sdl.command("help")
@@ -478,14 +566,15 @@ class SDGeneratorComfyUI(Star):
         settings = self._get_user_settings(user_id)
         workflow_idx = settings["workflow"]
 
-        params = self._get_generation_params(user_id)
-        global_positive = self.config.get("positive_prompt_global", "").strip()[:50]
-        global_negative = self.config.get("negative_prompt_global", "").strip()[:50]
+        cfg = self.config
+        workflow_info = self.workflow_parser.get_workflow(workflow_idx)
+        params = self._get_generation_params(workflow_idx, workflow_info)
+        global_positive = cfg.get("positive_prompt_global", "").strip()[:50]
+        global_negative = cfg.get("negative_prompt_global", "").strip()[:50]
 
         total = self.workflow_parser.get_workflow_count()
-        workflows_list = self.workflow_parser.list_workflows()
+        workflows_list = self._workflows()
 
-        workflow_info = self.workflow_parser.get_workflow(workflow_idx)
         if not workflow_info:
             yield event.plain_result(f"{params}\n\n❌ 工作流 [{workflow_idx}] 不存在")
             return
@@ -525,4 +614,11 @@ class SDGeneratorComfyUI(Star):
 
     async def cleanup(self):
         """清理资源"""
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._flush_save()
+        for task in (self._janitor_task, self._sync_task):
+            if task and not task.done():
+                task.cancel()
         await self.comfyui.close()
+        await close_session()
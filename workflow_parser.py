@@ -1,17 +1,36 @@
 """ComfyUI 工作流解析器"""
 
-import copy
-import glob
-import json
 import os
 import random
+import re
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from typing import Any
 
 from astrbot.api import logger
 
+try:
+    from . import json_compat
+except ImportError:
+    import json_compat
 
-@dataclass
+# 节点类别编码
+_CAT_CLIP = 1
+_CAT_LATENT = 2
+_CAT_SAMPLER = 3
+_CAT_LOAD = 4
+_CAT_OUTPUT = 5
+_CAT_TRT = 6
+
+# 提示词关键词，编译为单个正则以单次扫描匹配
+_NEGATIVE_KEYWORDS = ("worst quality", "low quality", "bad anatomy", "ugly")
+_POSITIVE_KEYWORDS = ("masterpiece", "best quality", "beautiful", "detailed")
+_NEG_RE = re.compile("|".join(map(re.escape, _NEGATIVE_KEYWORDS)))
+_POS_RE = re.compile("|".join(map(re.escape, _POSITIVE_KEYWORDS)))
+
+
+@dataclass(slots=True)
 class WorkflowNodeMapping:
     """工作流节点映射"""
 
@@ -19,15 +38,16 @@ class WorkflowNodeMapping:
     negative_prompt_node: str | None = None
     latent_image_node: str | None = None
     sampler_node: str | None = None
-    sampler_nodes: list[str] = field(default_factory=list)
+    sampler_nodes: tuple[str, ...] = ()
     load_image_node: str | None = None
     output_node: str | None = None
     positive_prompt_field: str = "text"
     negative_prompt_field: str = "text"
     has_tensorrt: bool = False
+    ckpt_name: str = ""
 
 
-@dataclass
+@dataclass(slots=True)
 class WorkflowInfo:
     """工作流信息"""
 
@@ -36,47 +56,84 @@ class WorkflowInfo:
     workflow_data: dict[str, Any] = field(default_factory=dict)
     node_mapping: WorkflowNodeMapping = field(default_factory=WorkflowNodeMapping)
     description: str = ""
+    # 按本工作流节点特化的输入写入函数，由解析器在加载时生成
+    apply_inputs: Callable[[str, str, int, str | None], dict[str, Any]] | None = field(
+        default=None, repr=False, compare=False
+    )
 
 
 class WorkflowParser:
     """工作流解析器"""
 
-    CLIP_TEXT_ENCODE_TYPES = [
-        "CLIPTextEncode",
-        "CLIPTextEncodeSDXL",
-        "AdvancedCLIPTextEncode",
-        "CLIPTextEncodeSD3",
-        "BNK_CLIPTextEncodeAdvanced",
-    ]
-    LATENT_IMAGE_TYPES = ["EmptyLatentImage", "EmptySD3LatentImage", "EmptyLatentImagePresets"]
-    SAMPLER_TYPES = [
-        "KSampler",
-        "KSamplerAdvanced",
-        "SamplerCustom",
-        "SamplerCustomAdvanced",
-        "KSampler (Efficient)",
-        "KSamplerSelect",
-    ]
-    LOAD_IMAGE_TYPES = ["LoadImage", "LoadImageMask", "LoadImageFromUrl"]
-    OUTPUT_TYPES = ["PreviewImage", "SaveImage", "SaveImageWebsocket"]
-    TRT_LOADER_TYPES = ["TensorRT Loader", "TensorRTLoader", "TensorRTLoaderSD3", "TensorRTLoaderFlux"]
-    PASSTHROUGH_TYPES = ["Reroute", "RerouteTextForCLIPTextEncodeForSDXL"]
+    CLIP_TEXT_ENCODE_TYPES = frozenset(
+        {
+            "CLIPTextEncode",
+            "CLIPTextEncodeSDXL",
+            "AdvancedCLIPTextEncode",
+            "CLIPTextEncodeSD3",
+            "BNK_CLIPTextEncodeAdvanced",
+        }
+    )
+    LATENT_IMAGE_TYPES = frozenset({"EmptyLatentImage", "EmptySD3LatentImage", "EmptyLatentImagePresets"})
+    SAMPLER_TYPES = frozenset(
+        {
+            "KSampler",
+            "KSamplerAdvanced",
+            "SamplerCustom",
+            "SamplerCustomAdvanced",
+            "KSampler (Efficient)",
+            "KSamplerSelect",
+        }
+    )
+    LOAD_IMAGE_TYPES = frozenset({"LoadImage", "LoadImageMask", "LoadImageFromUrl"})
+    OUTPUT_TYPES = frozenset({"PreviewImage", "SaveImage", "SaveImageWebsocket"})
+    TRT_LOADER_TYPES = frozenset({"TensorRT Loader", "TensorRTLoader", "TensorRTLoaderSD3", "TensorRTLoaderFlux"})
+    PASSTHROUGH_TYPES = frozenset({"Reroute", "RerouteTextForCLIPTextEncodeForSDXL"})
 
     def __init__(self, workflows_dir: str):
         self.workflows_dir = workflows_dir
         self.workflows: dict[int, WorkflowInfo] = {}
+        self._class_dispatch = self._build_class_dispatch()
         self._load_all_workflows()
 
+    def _build_class_dispatch(self) -> dict[str, int]:
+        """构建 class_type -> 类别编码 的查找表"""
+        dispatch: dict[str, int] = {}
+        # 逆序写入，使排在前面的类别优先
+        for types, cat in (
+            (self.TRT_LOADER_TYPES, _CAT_TRT),
+            (self.OUTPUT_TYPES, _CAT_OUTPUT),
+            (self.LOAD_IMAGE_TYPES, _CAT_LOAD),
+            (self.SAMPLER_TYPES, _CAT_SAMPLER),
+            (self.LATENT_IMAGE_TYPES, _CAT_LATENT),
+            (self.CLIP_TEXT_ENCODE_TYPES, _CAT_CLIP),
+        ):
+            for class_type in types:
+                dispatch[class_type] = cat
+        return dispatch
+
     def _load_all_workflows(self):
         """加载所有工作流"""
         if not os.path.exists(self.workflows_dir):
             os.makedirs(self.workflows_dir, exist_ok=True)
             return
 
-        json_files = sorted(glob.glob(os.path.join(self.workflows_dir, "*.json")))
-        for idx, file_path in enumerate(json_files, start=1):
+        with os.scandir(self.workflows_dir) as entries:
+            json_files = sorted(
+                entry.path
+                for entry in entries
+                if entry.name.endswith(".json") and not entry.name.startswith(".") and entry.is_file()
+            )
+        if not json_files:
+            return
+
+        # 并行读取解析，按文件顺序收集结果以保持索引稳定
+        with ThreadPoolExecutor(max_workers=min(8, len(json_files))) as executor:
+            futures = [executor.submit(self._parse_workflow_file, file_path) for file_path in json_files]
+
+        for idx, (file_path, future) in enumerate(zip(json_files, futures), start=1):
             try:
-                workflow_info = self._parse_workflow_file(file_path)
+                workflow_info = future.result()
                 if workflow_info:
                     self.workflows[idx] = workflow_info
                     logger.info(f"已加载工作流 [{idx}]: {workflow_info.name}")
@@ -85,12 +142,13 @@ class WorkflowParser:
 
     def _parse_workflow_file(self, file_path: str) -> WorkflowInfo | None:
         """解析工作流文件"""
-        with open(file_path, encoding="utf-8") as f:
-            workflow_data = json.load(f)
+        # 整文件一次读取：无缓冲 FileIO 按文件大小直接读入，省去缓冲区拷贝
+        with open(file_path, "rb", buffering=0) as f:
+            workflow_data = json_compat.loads(f.read())
 
         name = os.path.splitext(os.path.basename(file_path))[0]
         node_mapping = self._analyze_workflow_nodes(workflow_data)
-        description = self._extract_workflow_description(workflow_data, name)
+        description = self._extract_workflow_description(node_mapping, name)
 
         return WorkflowInfo(
             name=name,
@@ -98,34 +156,54 @@ class WorkflowParser:
             workflow_data=workflow_data,
             node_mapping=node_mapping,
             description=description,
+            apply_inputs=self._build_input_applier(workflow_data, node_mapping),
         )
 
     def _analyze_workflow_nodes(self, workflow_data: dict[str, Any]) -> WorkflowNodeMapping:
         """分析工作流节点"""
         mapping = WorkflowNodeMapping()
-        clip_text_nodes: list[tuple[str, dict]] = []
+        clip_text_nodes: list[tuple[str, str, str]] = []
+        sampler_nodes: list[str] = []
+        dispatch = self._class_dispatch
 
         for node_id, node_data in workflow_data.items():
             if not isinstance(node_data, dict):
                 continue
 
             class_type = node_data.get("class_type", "")
+            cat = dispatch.get(class_type)
+            if cat is None:
+                # 顺带记录首个带模型名的 Checkpoint 加载节点，供描述使用
+                if not mapping.ckpt_name and "Checkpoint" in class_type:
+                    mapping.ckpt_name = node_data.get("inputs", {}).get("ckpt_name", "") or ""
+                continue
 
-            if class_type in self.TRT_LOADER_TYPES:
-                mapping.has_tensorrt = True
-
-            if class_type in self.CLIP_TEXT_ENCODE_TYPES:
-                clip_text_nodes.append((node_id, node_data))
-            elif class_type in self.LATENT_IMAGE_TYPES:
+            if cat == _CAT_CLIP:
+                # 标题与文本预先转小写，供分类启发式复用
+                title = node_data.get("_meta", {}).get("title")
+                text = node_data.get("inputs", {}).get("text")
+                clip_text_nodes.append(
+                    (
+                        node_id,
+                        title.lower() if isinstance(title, str) else "",
+                        text.lower() if isinstance(text, str) else "",
+                    )
+                )
+            elif cat == _CAT_LATENT:
                 mapping.latent_image_node = node_id
-            elif class_type in self.SAMPLER_TYPES:
-                mapping.sampler_nodes.append(node_id)
-                if not mapping.sampler_node:
-                    mapping.sampler_node = node_id
-            elif class_type in self.LOAD_IMAGE_TYPES:
+            elif cat == _CAT_SAMPLER:
+                sampler_nodes.append(node_id)
+            elif cat == _CAT_LOAD:
                 mapping.load_image_node = node_id
-            elif class_type in self.OUTPUT_TYPES:
+            elif cat == _CAT_OUTPUT:
                 mapping.output_node = node_id
+            elif cat == _CAT_TRT:
+                mapping.has_tensorrt = True
+
+        # 采样器节点在解析时即已确认存在，固定为元组供 prepare_workflow 直接遍历
+        if sampler_nodes:
+            mapping.sampler_nodes = tuple(sampler_nodes)
+            mapping.sampler_node = sampler_nodes[0]
 
         self._classify_clip_nodes(clip_text_nodes, mapping, workflow_data)
         return mapping
@@ -134,34 +212,55 @@ class WorkflowParser:
         self,
         link_ref: Any,
         workflow_data: dict[str, Any],
-        target_types: list[str],
+        target_types: frozenset[str],
         max_depth: int = 10,
+        memo: dict[str, str | None] | None = None,
     ) -> str | None:
-        """递归追踪链路来源"""
-        if max_depth <= 0 or not isinstance(link_ref, list) or len(link_ref) < 1:
-            return None
-
-        source_id = str(link_ref[0])
-        if source_id not in workflow_data:
-            return None
-
-        source_node = workflow_data[source_id]
-        source_class = source_node.get("class_type", "")
-
-        if source_class in target_types:
-            return source_id
-
-        if source_class in self.PASSTHROUGH_TYPES:
-            inputs = source_node.get("inputs", {})
-            for value in inputs.values():
-                if isinstance(value, list) and len(value) >= 2:
-                    return self._trace_link_source(value, workflow_data, target_types, max_depth - 1)
-
-        return source_id
+        """沿中转节点迭代追踪链路来源
+
+        memo 以节点 id 缓存追踪结果，同一次分类中共享的中转链只走一遍。
+        """
+        passthrough_types = self.PASSTHROUGH_TYPES
+        path: list[str] = []
+        result: str | None = None
+
+        while max_depth > 0 and isinstance(link_ref, list) and link_ref:
+            source_id = str(link_ref[0])
+            if memo is not None and source_id in memo:
+                result = memo[source_id]
+                break
+
+            source_node = workflow_data.get(source_id)
+            if source_node is None:
+                result = None
+                break
+
+            path.append(source_id)
+            result = source_id
+            source_class = source_node.get("class_type", "")
+            if source_class in target_types or source_class not in passthrough_types:
+                break
+
+            next_ref = next(
+                (v for v in source_node.get("inputs", {}).values() if isinstance(v, list) and len(v) >= 2),
+                None,
+            )
+            if next_ref is None:
+                break
+            link_ref = next_ref
+            max_depth -= 1
+        else:
+            # 深度耗尽或链路无效
+            result = None
+
+        if memo is not None:
+            for node_id in path:
+                memo[node_id] = result
+        return result
 
     def _classify_clip_nodes(
         self,
-        clip_text_nodes: list[tuple[str, dict]],
+        clip_text_nodes: list[tuple[str, str, str]],
         mapping: WorkflowNodeMapping,
         workflow_data: dict[str, Any],
     ):
@@ -173,22 +272,24 @@ class WorkflowParser:
             mapping.positive_prompt_node = clip_text_nodes[0][0]
             return
 
-        clip_node_ids = {node_id for node_id, _ in clip_text_nodes}
+        clip_node_ids = frozenset(node_id for node_id, _, _ in clip_text_nodes)
+        memo: dict[str, str | None] = {}
 
-        if mapping.sampler_node and mapping.sampler_node in workflow_data:
-            sampler_inputs = workflow_data[mapping.sampler_node].get("inputs", {})
+        sampler_data = workflow_data.get(mapping.sampler_node) if mapping.sampler_node else None
+        if sampler_data is not None:
+            sampler_inputs = sampler_data.get("inputs", {})
             positive_ref = sampler_inputs.get("positive", [])
             negative_ref = sampler_inputs.get("negative", [])
 
             if isinstance(positive_ref, list) and len(positive_ref) >= 1:
-                traced = self._trace_link_source(positive_ref, workflow_data, self.CLIP_TEXT_ENCODE_TYPES)
+                traced = self._trace_link_source(positive_ref, workflow_data, self.CLIP_TEXT_ENCODE_TYPES, memo=memo)
                 if traced and traced in clip_node_ids:
                     mapping.positive_prompt_node = traced
                 elif str(positive_ref[0]) in clip_node_ids:
                     mapping.positive_prompt_node = str(positive_ref[0])
 
             if isinstance(negative_ref, list) and len(negative_ref) >= 1:
-                traced = self._trace_link_source(negative_ref, workflow_data, self.CLIP_TEXT_ENCODE_TYPES)
+                traced = self._trace_link_source(negative_ref, workflow_data, self.CLIP_TEXT_ENCODE_TYPES, memo=memo)
                 if traced and traced in clip_node_ids:
                     mapping.negative_prompt_node = traced
                 elif str(negative_ref[0]) in clip_node_ids:
@@ -197,42 +298,46 @@ class WorkflowParser:
         if mapping.positive_prompt_node and mapping.negative_prompt_node:
             return
 
-        for node_id, node_data in clip_text_nodes:
-            if node_id in (mapping.positive_prompt_node, mapping.negative_prompt_node):
+        # 尚未分配的节点，分配后即移除
+        remaining = set(clip_node_ids)
+        remaining.discard(mapping.positive_prompt_node)
+        remaining.discard(mapping.negative_prompt_node)
+
+        for node_id, title, _ in clip_text_nodes:
+            if node_id not in remaining:
                 continue
-            title = node_data.get("_meta", {}).get("title", "").lower()
             if not mapping.negative_prompt_node and ("negative" in title or "负" in title):
                 mapping.negative_prompt_node = node_id
+                remaining.discard(node_id)
             elif not mapping.positive_prompt_node and ("positive" in title or "正" in title):
                 mapping.positive_prompt_node = node_id
+                remaining.discard(node_id)
 
-        negative_keywords = ["worst quality", "low quality", "bad anatomy", "ugly"]
-        positive_keywords = ["masterpiece", "best quality", "beautiful", "detailed"]
+        if mapping.positive_prompt_node and mapping.negative_prompt_node:
+            return
 
-        for node_id, node_data in clip_text_nodes:
-            if node_id in (mapping.positive_prompt_node, mapping.negative_prompt_node):
+        for node_id, _, text in clip_text_nodes:
+            if node_id not in remaining:
                 continue
-            text = node_data.get("inputs", {}).get("text", "").lower()
-            if not mapping.negative_prompt_node and any(kw in text for kw in negative_keywords):
+            if not mapping.negative_prompt_node and _NEG_RE.search(text):
                 mapping.negative_prompt_node = node_id
-            elif not mapping.positive_prompt_node and any(kw in text for kw in positive_keywords):
+                remaining.discard(node_id)
+            elif not mapping.positive_prompt_node and _POS_RE.search(text):
                 mapping.positive_prompt_node = node_id
+                remaining.discard(node_id)
 
-        for node_id, _ in clip_text_nodes:
-            if node_id in (mapping.positive_prompt_node, mapping.negative_prompt_node):
+        for node_id, _, _ in clip_text_nodes:
+            if node_id not in remaining:
                 continue
             if not mapping.positive_prompt_node:
                 mapping.positive_prompt_node = node_id
             elif not mapping.negative_prompt_node:
                 mapping.negative_prompt_node = node_id
 
-    def _extract_workflow_description(self, workflow_data: dict[str, Any], default_name: str) -> str:
+    def _extract_workflow_description(self, mapping: WorkflowNodeMapping, default_name: str) -> str:
         """提取工作流描述"""
-        for node_data in workflow_data.values():
-            if isinstance(node_data, dict) and "Checkpoint" in node_data.get("class_type", ""):
-                ckpt_name = node_data.get("inputs", {}).get("ckpt_name", "")
-                if ckpt_name:
-                    return f"模型: {ckpt_name}"
+        if mapping.ckpt_name:
+            return f"模型: {mapping.ckpt_name}"
         return default_name
 
     def get_workflow(self, index: int) -> WorkflowInfo | None:
@@ -260,30 +365,61 @@ class WorkflowParser:
         seed: int | None = None,
         input_image_filename: str | None = None,
     ) -> tuple[dict[str, Any] | None, int | None, str | None]:
-        """准备工作流数据"""
+        """准备工作流数据
+
+        返回的工作流中未改写的节点与模板共享，调用方不得原地修改。
+        """
         workflow_info = self.get_workflow(workflow_index)
         if not workflow_info:
             logger.error(f"工作流索引 {workflow_index} 不存在")
             return None, None, None
 
-        workflow = copy.deepcopy(workflow_info.workflow_data)
-        mapping = workflow_info.node_mapping
-
-        if mapping.positive_prompt_node and mapping.positive_prompt_node in workflow:
-            workflow[mapping.positive_prompt_node]["inputs"][mapping.positive_prompt_field] = positive_prompt
-
-        if mapping.negative_prompt_node and mapping.negative_prompt_node in workflow:
-            workflow[mapping.negative_prompt_node]["inputs"][mapping.negative_prompt_field] = negative_prompt
-
-        actual_seed = seed if seed is not None else random.randint(1, 2**63 - 1)
-        for sampler_id in mapping.sampler_nodes:
-            if sampler_id in workflow:
-                if "inputs" not in workflow[sampler_id]:
-                    workflow[sampler_id]["inputs"] = {}
-                workflow[sampler_id]["inputs"]["seed"] = actual_seed
-
-        if input_image_filename and mapping.load_image_node:
-            if mapping.load_image_node in workflow:
-                workflow[mapping.load_image_node]["inputs"]["image"] = input_image_filename
+        actual_seed = seed if seed is not None else (random.getrandbits(63) or 1)
+        apply_inputs = workflow_info.apply_inputs
+        if apply_inputs is None:
+            # 非 _parse_workflow_file 构造的 WorkflowInfo，首次使用时补建
+            apply_inputs = workflow_info.apply_inputs = self._build_input_applier(
+                workflow_info.workflow_data, workflow_info.node_mapping
+            )
+        workflow = apply_inputs(positive_prompt, negative_prompt, actual_seed, input_image_filename)
 
         return workflow, actual_seed, negative_prompt
+
+    @classmethod
+    def _build_input_applier(
+        cls, template: dict[str, Any], mapping: WorkflowNodeMapping
+    ) -> Callable[[str, str, int, str | None], dict[str, Any]]:
+        """生成写入提示词、种子与输入图片的特化函数
+
+        节点 id 与字段名在此固定为闭包变量，调用时不再读取 mapping。
+        """
+        pos_id = mapping.positive_prompt_node if mapping.positive_prompt_node in template else None
+        neg_id = mapping.negative_prompt_node if mapping.negative_prompt_node in template else None
+        load_id = mapping.load_image_node if mapping.load_image_node in template else None
+        pos_field = mapping.positive_prompt_field
+        neg_field = mapping.negative_prompt_field
+        sampler_ids = mapping.sampler_nodes
+        overlay = cls._overlay_input
+
+        def apply_inputs(
+            positive_prompt: str, negative_prompt: str, seed: int, input_image_filename: str | None
+        ) -> dict[str, Any]:
+            # 浅层覆盖：仅为被改写的节点及其 inputs 建新 dict，其余内容与模板共享引用
+            workflow = dict(template)
+            if pos_id:
+                overlay(workflow, pos_id, pos_field, positive_prompt)
+            if neg_id:
+                overlay(workflow, neg_id, neg_field, negative_prompt)
+            for sampler_id in sampler_ids:
+                overlay(workflow, sampler_id, "seed", seed)
+            if input_image_filename and load_id:
+                overlay(workflow, load_id, "image", input_image_filename)
+            return workflow
+
+        return apply_inputs
+
+    @staticmethod
+    def _overlay_input(workflow: dict[str, Any], node_id: str, field_name: str, value: Any):
+        """以新 dict 覆盖节点的单个输入，不修改共享的原节点"""
+        node = workflow[node_id]
+        workflow[node_id] = {**node, "inputs": {**node.get("inputs", {}), field_name: value}}